@@ -1,22 +1,87 @@
-from flask import Flask, request, jsonify
+from gevent import monkey
+
+# Patch the stdlib before anything opens sockets so that requests and the
+# OpenAI SDK yield to other greenlets while waiting on the network
+monkey.patch_all()
+
+from flask import Flask, Response, request, jsonify, stream_with_context
+from flask.json.provider import JSONProvider
 import logging
 import time
 import os
-from collections import defaultdict
-from openai import OpenAI
-from tenacity import retry, stop_after_attempt, wait_exponential
+import json
+import hashlib
+import re
+import stat
+import unicodedata
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from openai import (
+    OpenAI,
+    APIConnectionError,
+    APITimeoutError,
+    InternalServerError,
+    RateLimitError,
+)
+from tenacity import (
+    retry,
+    retry_if_exception,
+    stop_after_attempt,
+    wait_exponential,
+)
 from pathlib import Path
 from datetime import datetime, timedelta
 import threading
+import httpx
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from cachetools import TTLCache, cached
+from cachetools.keys import hashkey
+import geonamescache
+import orjson
 from dotenv import load_dotenv
 
 load_dotenv()
 
+# Required configuration, a missing key fails at startup instead of per request
+OPENAI_API_KEY = os.environ["OPENAI_API_KEY"]
+GOOGLE_GEOCODING_API_KEY = os.environ["GOOGLE_GEOCODING_API_KEY"]
+OPENWEATHER_API_KEY = os.environ["OPENWEATHER_API_KEY"]
+
+GEOCODE_URL = "https://maps.googleapis.com/maps/api/geocode/json"
+FORECAST_URL = "https://api.openweathermap.org/data/2.5/forecast"
+
+
+# A bounded, keep-alive connection pool for OpenAI, shared by all greenlets of
+# a worker. The timeout applies to every call, so connecting fails fast while
+# a completion may take up to 30s. Retries, including rate limit errors, are
+# done by create_chat_completion, so the SDK's own retries are disabled
+client = OpenAI(
+    api_key=OPENAI_API_KEY,
+    http_client=httpx.Client(
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+        timeout=httpx.Timeout(30, connect=3),
+    ),
+    max_retries=0,
+)
+
+
+class OrjsonProvider(JSONProvider):
+    """Flask JSON provider backed by orjson, used by request.json and jsonify"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
+# Larger bodies are rejected by Flask with 413 before they are parsed
+app.config["MAX_CONTENT_LENGTH"] = 256 * 1024
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -27,84 +92,291 @@ TRIGGER_PHRASES = ["hey omi", "hey, omi"]  # Base triggers
 PARTIAL_FIRST = ["hey", "hey,"]  # First part of trigger
 PARTIAL_SECOND = ["omi"]  # Second part of trigger
 QUESTION_AGGREGATION_TIME = 5  # seconds to wait for collecting the question
+MAX_SEGMENTS = 64  # only the most recent segments of a request are processed
+MAX_SEGMENT_TEXT_LENGTH = 2048  # characters of each segment that are processed
+
+# Match all phrases of a trigger kind in a single pass over the segment text
+TRIGGER_PATTERN = re.compile("|".join(re.escape(t.lower()) for t in TRIGGER_PHRASES))
+PARTIAL_SECOND_PATTERN = re.compile(
+    "|".join(re.escape(p.lower()) for p in PARTIAL_SECOND)
+)
+PARTIAL_FIRST_SUFFIXES = tuple(p.lower() for p in PARTIAL_FIRST)
+
+
+@dataclass(slots=True)
+class SessionState:
+    messages: list = field(default_factory=list)
+    trigger_detected: bool = False
+    trigger_time: float = 0.0
+    collected_question: list = field(default_factory=list)
+    response_sent: bool = False
+    partial_trigger: bool = False
+    partial_trigger_time: float = 0.0
+    last_activity: float = 0.0
 
 
 # Replace the message buffer with a class to better manage state
 class MessageBuffer:
     def __init__(self):
-        self.buffers = {}
+        # Ordered from least to most recently active session
+        self.buffers = OrderedDict()
         self.lock = threading.Lock()
-        self.cleanup_interval = 300  # 5 minutes
-        self.last_cleanup = time.time()
+        self.cleanup_interval = 60  # seconds between janitor runs
+        self.session_timeout = 3600  # Remove sessions older than 1 hour
+
+        # Expire sessions and cached narrations in the background instead of
+        # on the request path
+        threading.Thread(target=self.run_janitor, daemon=True).start()
 
     def get_buffer(self, session_id):
         current_time = time.time()
 
-        # Cleanup old sessions periodically
-        if current_time - self.last_cleanup > self.cleanup_interval:
-            self.cleanup_old_sessions()
-
         with self.lock:
-            if session_id not in self.buffers:
-                self.buffers[session_id] = {
-                    "messages": [],
-                    "trigger_detected": False,
-                    "trigger_time": 0,
-                    "collected_question": [],
-                    "response_sent": False,
-                    "partial_trigger": False,
-                    "partial_trigger_time": 0,
-                    "last_activity": current_time,
-                }
+            buffer_data = self.buffers.get(session_id)
+            if buffer_data is None:
+                buffer_data = SessionState(last_activity=current_time)
+                self.buffers[session_id] = buffer_data
             else:
-                self.buffers[session_id]["last_activity"] = current_time
+                buffer_data.last_activity = current_time
+                self.buffers.move_to_end(session_id)
 
-        return self.buffers[session_id]
+        return buffer_data
 
     def cleanup_old_sessions(self):
-        current_time = time.time()
+        """Drop sessions inactive for longer than session_timeout
+
+        Buffers are kept in order of last activity, so the expired sessions
+        are exactly the ones at the front. The loop stops at the first fresh
+        session and its cost grows with the number of expired sessions only.
+        """
+        cutoff = time.time() - self.session_timeout
         with self.lock:
-            expired_sessions = [
-                session_id
-                for session_id, data in self.buffers.items()
-                if current_time - data["last_activity"]
-                > 3600  # Remove sessions older than 1 hour
-            ]
-            for session_id in expired_sessions:
-                del self.buffers[session_id]
-            self.last_cleanup = current_time
+            while (
+                self.buffers
+                and next(iter(self.buffers.values())).last_activity < cutoff
+            ):
+                session_id, _ = self.buffers.popitem(last=False)
+                notification_cooldowns.pop(session_id, None)
+
+    def run_janitor(self):
+        while True:
+            time.sleep(self.cleanup_interval)
+            try:
+                self.cleanup_old_sessions()
+            except Exception as e:
+                logger.error(f"Error cleaning up sessions: {str(e)}")
+            try:
+                sweep_forecast_text_cache()
+            except Exception as e:
+                logger.error(f"Error sweeping forecast cache: {str(e)}")
 
 
 # Replace the message_buffer defaultdict with our new class
 message_buffer = MessageBuffer()
 
-# Add cooldown tracking
-notification_cooldowns = defaultdict(float)
+# Add cooldown tracking, entries expire together with inactive sessions
+notification_cooldowns = TTLCache(maxsize=100_000, ttl=3600)
 NOTIFICATION_COOLDOWN = 10  # 10 seconds cooldown between notifications for each session
 
 # Add these near the top of the file, after the imports
 if os.getenv("HTTPS_PROXY"):
     os.environ["OPENAI_PROXY"] = os.getenv("HTTPS_PROXY")
 
+# Shared HTTP session so the Google and OpenWeather connections are kept alive
+# and reused instead of doing a fresh TCP + TLS handshake on every request
+session = requests.Session()
+adapter = HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=64,
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        raise_on_status=False,  # hand the last response back to the caller
+    ),
+)
+session.mount("https://", adapter)
+HTTP_TIMEOUT = (3, 10)  # (connect, read) timeout in seconds
+
+# Cache lifetimes in seconds
+GEOCODE_CACHE_TTL = 7 * 24 * 3600  # coordinates of a city don't change
+FORECAST_CACHE_TTL = 15 * 60  # forecasts for a location are stable for ~15 min
+FORECAST_TEXT_CACHE_TTL = 3600  # narrated forecasts, kept on disk
+LOCATION_CACHE_TTL = 24 * 3600  # extracted "City, Country" per question
+
+# Narrated forecasts are shared between workers through files in this directory,
+# which must only be accessible by the user running the app
+FORECAST_TEXT_CACHE_DIR = Path(
+    os.getenv("OMI_CACHE_DIR")
+    or Path(os.getenv("XDG_CACHE_HOME") or Path.home() / ".cache")
+    / "omi_weather_forecast"
+)
+
+# Background workers for network calls that can overlap with the OpenAI request
+executor = ThreadPoolExecutor(max_workers=16)
+
+# Matches questions ending in "... in <city>, <country>". Place names are a few
+# words without a preposition, so the match starts at the last "in", "for" or
+# "at" and long phrases like "in the city where I live" are not guessed at all
+LOCATION_WORD = r"(?!(?:in|for|at)\b)[a-z][a-z.'-]*"
+LOCATION_NAME = rf"{LOCATION_WORD}(?:\s+{LOCATION_WORD}){{0,3}}"
+LOCATION_PATTERN = re.compile(
+    rf"\b(?:in|for|at)\s+({LOCATION_NAME})\s*,\s*({LOCATION_NAME})\s*[?.!]*$",
+    re.IGNORECASE,
+)
+
+
+def guess_location(question):
+    """Cheap local guess of (city, country) from the question, or None
+
+    Only questions ending in a place followed by a known country or US state
+    are guessed, e.g. "... in Paris, Texas?". "at noon" or "in the park" are
+    not worth a geocoding request.
+    """
+    match = LOCATION_PATTERN.search(question.strip())
+    if not match:
+        return None
+    country = REGION_NAMES.get(normalize_place_name(match.group(2)))
+    if not country:
+        return None
+    return match.group(1).strip(), country
+
+
+def guess_matches(guessed_location, city, country):
+    """Check whether a guessed location is the one OpenAI extracted
+
+    Only the case may differ, which Google ignores and the geocode cache key
+    doesn't include, so the prefetch was the same query as geocode_location.
+    """
+    return geocode_cache_key(*guessed_location) == geocode_cache_key(city, country)
+
+
+# Both completions are short, templated tasks that don't need a large model
+MODEL = os.getenv("OMI_MODEL", "gpt-4o-mini")
+SYSTEM_PROMPT = "You are Omi, a helpful AI assistant. Provide clear, concise, and friendly responses."
+LOCATION_SYSTEM_PROMPT = "Return only 'City, Country'."
+# Shared by every request, only the user message is built per call
+SYSTEM_MESSAGE = {"role": "system", "content": SYSTEM_PROMPT}
+LOCATION_SYSTEM_MESSAGE = {"role": "system", "content": LOCATION_SYSTEM_PROMPT}
+OPENAI_ERROR_RESPONSE = "I'm sorry, I encountered an error processing your request."
+
+# Account limits for OpenAI, requests are paced to stay below them
+OPENAI_REQUESTS_PER_MINUTE = int(os.getenv("OPENAI_REQUESTS_PER_MINUTE", "200"))
+OPENAI_TOKENS_PER_MINUTE = int(os.getenv("OPENAI_TOKENS_PER_MINUTE", "40000"))
+# Each gunicorn worker paces itself, so the account limits are split between
+# them. gunicorn reads the number of workers from the same variable
+WORKER_COUNT = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+OPENAI_RATE_LIMIT_MAX_WAIT = 60  # longest Retry-After honoured, in seconds
+
+
+class TokenBucket:
+    """Paces calls to stay within a requests and tokens per minute budget"""
+
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.available_requests = requests_per_minute
+        self.available_tokens = tokens_per_minute
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
 
-@retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10))
-def get_openai_response(text):
+    def refill(self):
+        current_time = time.monotonic()
+        elapsed_minutes = (current_time - self.last_refill) / 60
+        self.available_requests = min(
+            self.requests_per_minute,
+            self.available_requests + elapsed_minutes * self.requests_per_minute,
+        )
+        self.available_tokens = min(
+            self.tokens_per_minute,
+            self.available_tokens + elapsed_minutes * self.tokens_per_minute,
+        )
+        self.last_refill = current_time
+
+    def acquire(self, tokens):
+        """Block until one request and the given number of tokens are available"""
+        tokens = min(tokens, self.tokens_per_minute)
+        while True:
+            with self.lock:
+                self.refill()
+                if self.available_requests >= 1 and self.available_tokens >= tokens:
+                    self.available_requests -= 1
+                    self.available_tokens -= tokens
+                    return
+                wait_time = 60 * max(
+                    (1 - self.available_requests) / self.requests_per_minute,
+                    (tokens - self.available_tokens) / self.tokens_per_minute,
+                )
+            logger.info(f"OpenAI rate limit reached, waiting {wait_time:.1f}s")
+            time.sleep(wait_time)
+
+
+openai_rate_limiter = TokenBucket(
+    OPENAI_REQUESTS_PER_MINUTE / WORKER_COUNT, OPENAI_TOKENS_PER_MINUTE / WORKER_COUNT
+)
+
+
+def estimate_tokens(messages, max_tokens):
+    """Upper bound of the tokens a chat completion counts against the limit
+
+    Roughly four characters per token for English text. This only paces the
+    rate limiter, so a tokenizer (and downloading its vocabulary on the first
+    request) isn't worth it.
+    """
+    prompt_tokens = sum(len(m["content"]) // 4 + 1 for m in messages)
+    return prompt_tokens + max_tokens
+
+
+def is_retryable(error):
+    """Transient failures, and rate limits that aren't an exhausted quota"""
+    if isinstance(error, RateLimitError):
+        return error.code != "insufficient_quota"
+    return isinstance(error, (APIConnectionError, APITimeoutError, InternalServerError))
+
+
+def wait_for_retry(retry_state):
+    """Wait as long as a rate limit response asks for, else back off"""
+    error = retry_state.outcome.exception()
+    if isinstance(error, RateLimitError):
+        try:
+            retry_after = float(error.response.headers["retry-after"])
+            return min(retry_after, OPENAI_RATE_LIMIT_MAX_WAIT)
+        except (KeyError, ValueError):
+            pass
+    return wait_exponential(multiplier=1, min=4, max=10)(retry_state)
+
+
+# The token bucket keeps this worker below its share of the limits, a rate
+# limit error still happens when the account is shared and is retried as well
+@retry(
+    retry=retry_if_exception(is_retryable),
+    stop=stop_after_attempt(3),
+    wait=wait_for_retry,
+    reraise=True,
+)
+def create_chat_completion(messages, max_tokens, stream=False):
+    """Chat completion paced by the OpenAI rate limiter"""
+    openai_rate_limiter.acquire(estimate_tokens(messages, max_tokens))
+    return client.chat.completions.create(
+        model=MODEL,
+        messages=messages,
+        temperature=0.7,
+        max_tokens=max_tokens,
+        stream=stream,
+    )
+
+
+def get_openai_response(text, system_message=SYSTEM_MESSAGE, max_tokens=150):
     """Get response from OpenAI for the user's question"""
     try:
         logger.info(f"Sending question to OpenAI: {text}")
 
-        response = client.chat.completions.create(
-            model="gpt-4",
-            messages=[
-                {
-                    "role": "system",
-                    "content": "You are Omi, a helpful AI assistant. Provide clear, concise, and friendly responses.",
-                },
+        response = create_chat_completion(
+            [
+                system_message,
                 {"role": "user", "content": text},
             ],
-            temperature=0.7,
-            max_tokens=150,
-            timeout=30,
+            max_tokens=max_tokens,
         )
 
         answer = response.choices[0].message.content.strip()
@@ -112,7 +384,208 @@ def get_openai_response(text):
         return answer
     except Exception as e:
         logger.error(f"Error getting OpenAI response: {str(e)}")
-        return "I'm sorry, I encountered an error processing your request."
+        return OPENAI_ERROR_RESPONSE
+
+
+# Filler words ignored when matching paraphrased location questions, so that
+# "weather in Berlin?" and "how's the Berlin weather" share a cache entry
+LOCATION_STOP_WORDS = frozenset(
+    {
+        "a", "about", "and", "at", "be", "can", "do", "does", "for", "forecast",
+        "going", "hey", "how", "how's", "hows", "in", "is", "it", "it's", "its",
+        "like", "me", "of", "omi", "outside", "please", "tell", "the", "this",
+        "to", "today", "tomorrow", "tonight", "week", "weekend", "weather",
+        "what", "what's", "whats", "will", "you",
+    }
+)  # fmt: skip
+
+location_cache = TTLCache(maxsize=10_000, ttl=LOCATION_CACHE_TTL)
+location_cache_lock = threading.Lock()
+
+
+def location_cache_key(question):
+    """Key a question by its words, ignoring order, case and filler words"""
+    return frozenset(re.findall(r"[a-z']+", question.lower())) - LOCATION_STOP_WORDS
+
+
+def normalize_place_name(text):
+    """Lowercase ASCII words of a place name, e.g. Saint-Étienne -> saint etienne"""
+    ascii_text = unicodedata.normalize("NFKD", text).encode("ascii", "ignore").decode()
+    return " ".join(re.findall(r"[a-z]+", ascii_text.lower()))
+
+
+# Words after "in" that are rarely meant as the city of that name, e.g.
+# "weather in march", "dry in time for the game" or "rain in Kent"
+NOT_CITY_NAMES = frozenset(
+    {
+        "january", "february", "march", "april", "may", "june", "july",
+        "august", "september", "october", "november", "december", "monday",
+        "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday",
+        "spring", "summer", "autumn", "fall", "winter", "time", "reading",
+        "university", "college", "school", "home", "work", "office", "town",
+        "city", "center", "centre", "downtown", "general", "case", "order",
+        "advance", "person", "bed", "church", "hope", "mobile", "union",
+        "victory", "liberty", "independence", "progress", "paradise",
+        # Usually meant as the county or province rather than the city
+        "kent", "surrey", "norfolk", "essex", "ontario", "alberta",
+    }
+)  # fmt: skip
+
+# Single words match common words too often, so without a country or state
+# after the name only well known cities count
+MIN_SINGLE_WORD_CITY_POPULATION = 100_000
+# A city wins over others of the same name only if it is this many times bigger,
+# otherwise "victoria" or "birmingham" is left to GPT
+MIN_POPULATION_RATIO = 5
+
+
+def build_gazetteer():
+    """Index the GeoNames cities (>15k inhabitants) and countries by name
+
+    Cities are indexed by their canonical name, and big cities also by their
+    plain ASCII alternate names ("New York" for "New York City"). Alternate
+    names that are another city's canonical name are left out, so "victoria"
+    or "islamabad" never resolve to a bigger city that was once called so.
+    """
+    geonames = geonamescache.GeonamesCache()
+    countries = geonames.get_countries()
+    us_states = geonames.get_us_states()
+
+    city_names = defaultdict(list)
+    city_aliases = defaultdict(list)
+    for city in geonames.get_cities().values():
+        if city["countrycode"] == "US" and city["admin1code"] in us_states:
+            # "Paris, Texas" geocodes far better than "Paris, United States"
+            region = us_states[city["admin1code"]]["name"]
+        elif city["countrycode"] in countries:
+            region = countries[city["countrycode"]]["name"]
+        else:
+            continue
+        name, region = city["name"].strip(), region.strip()
+        if "," in name or "," in region:
+            # Would break the "City, Country" format the webhook expects
+            continue
+
+        candidate = (city["population"], name, region)
+        city_names[normalize_place_name(name)].append(candidate)
+        if city["population"] >= 1_000_000:
+            # Smaller places have too many ambiguous alternate names
+            for alias in city["alternatenames"]:
+                if len(alias) >= 4 and re.fullmatch(r"[A-Za-z ]+", alias):
+                    city_aliases[alias.lower()].append(candidate)
+
+    for excluded in NOT_CITY_NAMES:
+        city_names.pop(excluded, None)
+    city_aliases = {
+        alias: candidates
+        for alias, candidates in city_aliases.items()
+        if alias not in city_names and alias not in NOT_CITY_NAMES
+    }
+
+    regions = {normalize_place_name(c["name"]): c["name"] for c in countries.values()}
+    regions.update(
+        {normalize_place_name(s["name"]): s["name"] for s in us_states.values()}
+    )
+    regions.update(
+        {
+            "usa": "United States",
+            "america": "United States",
+            "uk": "United Kingdom",
+            "britain": "United Kingdom",
+            "england": "United Kingdom",
+            "scotland": "United Kingdom",
+            "wales": "United Kingdom",
+        }
+    )
+    return dict(city_names), city_aliases, regions
+
+
+CITY_NAMES, CITY_ALIASES, REGION_NAMES = build_gazetteer()
+MAX_PLACE_NAME_WORDS = 4
+LOCATION_PREPOSITIONS = frozenset({"in", "for", "at", "near", "around"})
+
+
+def find_known_city(question):
+    """Look up "City, Country" for a known city named in the question, or None
+
+    Only names right after a location preposition ("weather in Berlin") are
+    considered, so that city names which are also common words don't match.
+    Canonical city names win over alternate names. A country or US state
+    right after the name ("Paris, Texas") narrows the candidates, otherwise a
+    city only wins if it is much bigger than the others with that name.
+    Ambiguous questions return None and are left to GPT.
+    """
+    words = normalize_place_name(question).split()
+
+    def ngrams_at(start):
+        return [
+            (start + length, " ".join(words[start : start + length]))
+            for length in range(1, MAX_PLACE_NAME_WORDS + 1)
+            if start + length <= len(words)
+        ]
+
+    # Each place name with the regions named directly after it
+    place_names = [
+        (name, {REGION_NAMES[n] for _, n in ngrams_at(end) if n in REGION_NAMES})
+        for start in range(1, len(words))
+        if words[start - 1] in LOCATION_PREPOSITIONS
+        for end, name in ngrams_at(start)
+    ]
+
+    for index in (CITY_NAMES, CITY_ALIASES):
+        candidates = [
+            candidate
+            for name, regions in place_names
+            for candidate in index.get(name, ())
+            if (
+                candidate[2] in regions
+                if regions
+                else " " in name or candidate[0] >= MIN_SINGLE_WORD_CITY_POPULATION
+            )
+        ]
+        if not candidates:
+            continue
+        candidates.sort(reverse=True)
+        if (
+            len(candidates) > 1
+            and candidates[0][0] < MIN_POPULATION_RATIO * candidates[1][0]
+        ):
+            return None
+        _, city, region = candidates[0]
+        return f"{city}, {region}"
+
+    return None
+
+
+def lookup_location(question):
+    """ "City, Country" from the gazetteer or an earlier answer, or None"""
+    location = find_known_city(question)
+    if location:
+        logger.info(f"Found known city in question: {location}")
+        return location
+
+    key = location_cache_key(question)
+    with location_cache_lock:
+        location = location_cache.get(key)
+    if location is not None:
+        logger.info(f"Location cache hit for {sorted(key)}: {location}")
+    return location
+
+
+def ask_location(question):
+    """Ask OpenAI for "City, Country" in the question and remember the answer"""
+    location_query = f"Extract the city and country from the following question, comma separate it, it should be the only thing returned: {question}"
+    # "City, Country" is only a handful of tokens
+    location = get_openai_response(
+        location_query, system_message=LOCATION_SYSTEM_MESSAGE, max_tokens=20
+    )
+
+    # Only cache answers that look like a location, never error replies
+    key = location_cache_key(question)
+    if key and location != OPENAI_ERROR_RESPONSE and len(location.split(",")) == 2:
+        with location_cache_lock:
+            location_cache[key] = location
+    return location
 
 
 @app.route("/webhook", methods=["POST"])
@@ -122,29 +595,56 @@ def webhook():
         data = request.json
         logger.info(f"Received data: {data}")
 
+        if not isinstance(data, dict):
+            logger.error("Request body is not a JSON object")
+            return (
+                jsonify({"status": "error", "message": "Expected a JSON object"}),
+                400,
+            )
+
         session_id = data.get("session_id")
         uid = request.args.get("uid")
         logger.info(f"Processing request for session_id: {session_id}, uid: {uid}")
 
-        if not session_id:
+        if not session_id or not isinstance(session_id, str):
             logger.error("No session_id provided in request")
             return (
                 jsonify({"status": "error", "message": "No session_id provided"}),
                 400,
             )
 
+        segments = data.get("segments", [])
+        if not isinstance(segments, list) or not all(
+            isinstance(segment, dict) and isinstance(segment.get("text"), str)
+            for segment in segments
+        ):
+            logger.error("Invalid segments in request")
+            return (
+                jsonify(
+                    {
+                        "status": "error",
+                        "message": "segments must be a list of objects with a text string",
+                    }
+                ),
+                400,
+            )
+        segments = segments[-MAX_SEGMENTS:]
+
+        # Keepalive requests without any text don't need the session buffer
+        if not any(segment.get("text") for segment in segments):
+            return jsonify({"status": "success"}), 200
+
         current_time = time.time()
         buffer_data = message_buffer.get_buffer(session_id)
-        segments = data.get("segments", [])
         has_processed = False
 
         # Add debug logging
         logger.debug(f"Current buffer state for session {session_id}: {buffer_data}")
 
         # Only check cooldown if we have a trigger and are about to process
-        if buffer_data["trigger_detected"] and not buffer_data["response_sent"]:
-            time_since_last_notification = (
-                current_time - notification_cooldowns[session_id]
+        if buffer_data.trigger_detected and not buffer_data.response_sent:
+            time_since_last_notification = current_time - notification_cooldowns.get(
+                session_id, 0.0
             )
             if time_since_last_notification < NOTIFICATION_COOLDOWN:
                 logger.info(
@@ -157,117 +657,117 @@ def webhook():
             if not segment.get("text") or has_processed:
                 continue
 
-            text = segment["text"].lower().strip()
+            text = segment["text"][:MAX_SEGMENT_TEXT_LENGTH].lower().strip()
             logger.info(f"Processing text segment: '{text}'")
 
             # Check for complete trigger phrases first
-            if (
-                any(trigger in text for trigger in [t.lower() for t in TRIGGER_PHRASES])
-                and not buffer_data["trigger_detected"]
-            ):
+            if TRIGGER_PATTERN.search(text) and not buffer_data.trigger_detected:
                 logger.info(f"Complete trigger phrase detected in session {session_id}")
-                buffer_data["trigger_detected"] = True
-                buffer_data["trigger_time"] = current_time
-                buffer_data["collected_question"] = []
-                buffer_data["response_sent"] = False
-                buffer_data["partial_trigger"] = False
+                buffer_data.trigger_detected = True
+                buffer_data.trigger_time = current_time
+                buffer_data.collected_question = []
+                buffer_data.response_sent = False
+                buffer_data.partial_trigger = False
                 notification_cooldowns[session_id] = (
                     current_time  # Set cooldown when trigger is detected
                 )
 
                 # Extract any question part that comes after the trigger
-                question_part = (
-                    text.split("omi,")[-1].strip() if "omi," in text.lower() else ""
-                )
+                question_part = text.split("omi,")[-1].strip() if "omi," in text else ""
                 if question_part:
-                    buffer_data["collected_question"].append(question_part)
+                    buffer_data.collected_question.append(question_part)
                     logger.info(
                         f"Collected question part from trigger: {question_part}"
                     )
                 continue
 
             # Check for partial triggers
-            if not buffer_data["trigger_detected"]:
+            if not buffer_data.trigger_detected:
                 # Check for first part of trigger
-                if any(text.endswith(part.lower()) for part in PARTIAL_FIRST):
+                if text.endswith(PARTIAL_FIRST_SUFFIXES):
                     logger.info(
                         f"First part of trigger detected in session {session_id}"
                     )
-                    buffer_data["partial_trigger"] = True
-                    buffer_data["partial_trigger_time"] = current_time
+                    buffer_data.partial_trigger = True
+                    buffer_data.partial_trigger_time = current_time
                     continue
 
                 # Check for second part if we're waiting for it
-                if buffer_data["partial_trigger"]:
-                    time_since_partial = (
-                        current_time - buffer_data["partial_trigger_time"]
-                    )
+                if buffer_data.partial_trigger:
+                    time_since_partial = current_time - buffer_data.partial_trigger_time
                     if (
                         time_since_partial <= 2.0
                     ):  # 2 second window to complete the trigger
-                        if any(part.lower() in text.lower() for part in PARTIAL_SECOND):
+                        if PARTIAL_SECOND_PATTERN.search(text):
                             logger.info(
                                 f"Complete trigger detected across segments in session {session_id}"
                             )
-                            buffer_data["trigger_detected"] = True
-                            buffer_data["trigger_time"] = current_time
-                            buffer_data["collected_question"] = []
-                            buffer_data["response_sent"] = False
-                            buffer_data["partial_trigger"] = False
+                            buffer_data.trigger_detected = True
+                            buffer_data.trigger_time = current_time
+                            buffer_data.collected_question = []
+                            buffer_data.response_sent = False
+                            buffer_data.partial_trigger = False
 
                             # Extract any question part that comes after "omi"
                             question_part = (
-                                text.split("omi,")[-1].strip()
-                                if "omi," in text.lower()
-                                else ""
+                                text.split("omi,")[-1].strip() if "omi," in text else ""
                             )
                             if question_part:
-                                buffer_data["collected_question"].append(question_part)
+                                buffer_data.collected_question.append(question_part)
                                 logger.info(
                                     f"Collected question part from second trigger part: {question_part}"
                                 )
                             continue
                     else:
                         # Reset partial trigger if too much time has passed
-                        buffer_data["partial_trigger"] = False
+                        buffer_data.partial_trigger = False
 
             # If trigger was detected, collect the question
             if (
-                buffer_data["trigger_detected"]
-                and not buffer_data["response_sent"]
+                buffer_data.trigger_detected
+                and not buffer_data.response_sent
                 and not has_processed
             ):
-                time_since_trigger = current_time - buffer_data["trigger_time"]
+                time_since_trigger = current_time - buffer_data.trigger_time
                 logger.info(f"Time since trigger: {time_since_trigger} seconds")
 
                 if time_since_trigger <= QUESTION_AGGREGATION_TIME:
-                    buffer_data["collected_question"].append(text)
+                    buffer_data.collected_question.append(text)
                     logger.info(f"Collecting question part: {text}")
                     logger.info(
-                        f"Current collected question: {' '.join(buffer_data['collected_question'])}"
+                        f"Current collected question: {' '.join(buffer_data.collected_question)}"
                     )
 
                 # Check if we should process the question
                 should_process = (
                     (
                         time_since_trigger > QUESTION_AGGREGATION_TIME
-                        and buffer_data["collected_question"]
+                        and buffer_data.collected_question
                     )
-                    or (buffer_data["collected_question"] and "?" in text)
+                    or (buffer_data.collected_question and "?" in text)
                     or (time_since_trigger > QUESTION_AGGREGATION_TIME * 1.5)
                 )
 
-                if should_process and buffer_data["collected_question"]:
+                if should_process and buffer_data.collected_question:
                     # Process question and send response
-                    full_question = " ".join(buffer_data["collected_question"]).strip()
+                    full_question = " ".join(buffer_data.collected_question).strip()
                     if not full_question.endswith("?"):
                         full_question += "?"
 
                     logger.info(f"Processing complete question: {full_question}")
 
-                    # Use OpenAI to extract city and country
-                    location_query = f"Extract the city and country from the following question, comma separate it, it should be the only thing returned: {full_question}"
-                    location_response = get_openai_response(location_query)
+                    guessed_location = None
+                    geocode_future = None
+                    location_response = lookup_location(full_question)
+                    if location_response is None:
+                        # Start geocoding a locally guessed location while
+                        # OpenAI extracts the city and country
+                        guessed_location = guess_location(full_question)
+                        if guessed_location:
+                            geocode_future = executor.submit(
+                                request_geocode, *guessed_location
+                            )
+                        location_response = ask_location(full_question)
                     logger.info(f"Extracted location: {location_response}")
 
                     # Call the weather forecast function
@@ -277,15 +777,27 @@ def webhook():
                             location_parts[0].strip(),
                             location_parts[1].strip(),
                         )
-                        forecast_response = get_weather_forecast(city, country)
+                        coordinates = None
+                        if geocode_future and guess_matches(
+                            guessed_location, city, country
+                        ):
+                            try:
+                                coordinates = geocode_future.result()
+                                remember_geocode(*guessed_location, coordinates)
+                            except Exception as e:
+                                logger.info(f"Prefetched geocoding failed: {str(e)}")
+
+                        forecast_response = get_weather_forecast(
+                            city, country, coordinates
+                        )
                         logger.info(f"Weather forecast: {forecast_response}")
 
                         # Reset all states
-                        buffer_data["trigger_detected"] = False
-                        buffer_data["trigger_time"] = 0
-                        buffer_data["collected_question"] = []
-                        buffer_data["response_sent"] = True
-                        buffer_data["partial_trigger"] = False
+                        buffer_data.trigger_detected = False
+                        buffer_data.trigger_time = 0.0
+                        buffer_data.collected_question = []
+                        buffer_data.response_sent = True
+                        buffer_data.partial_trigger = False
                         has_processed = True
 
                         return jsonify({"message": forecast_response}), 200
@@ -356,55 +868,259 @@ def get_weather():
         return jsonify({"error": str(e)}), 500
 
 
-def generate_forecast_text(daily_forecast):
+def server_sent_event(data, event=None):
+    """Format data as a server-sent event, one data line per text line"""
+    lines = [f"event: {event}"] if event else []
+    lines += [f"data: {line}" for line in data.split("\n")]
+    return "\n".join(lines) + "\n\n"
+
+
+@app.route("/weather/stream", methods=["GET"])
+def stream_weather():
+    """Like /weather, but streams the forecast text as server-sent events
+
+    The text is forwarded while OpenAI generates it, so clients such as a
+    text-to-speech frontend can start after the first tokens arrive.
+    """
+    location = request.args.get("location")
+
+    if not location:
+        return jsonify({"error": "Location is required"}), 400
+
+    location_parts = location.split(",")
+    if len(location_parts) != 2:
+        return (
+            jsonify({"error": "Invalid location format. Use 'City, Country'"}),
+            400,
+        )
+
+    try:
+        city, country = location_parts[0].strip(), location_parts[1].strip()
+        daily_forecast = get_daily_forecast(city, country)
+    except LookupError as e:
+        return jsonify({"error": str(e)}), 404
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+    def generate():
+        try:
+            for chunk in stream_forecast_text(daily_forecast):
+                yield server_sent_event(chunk)
+            yield server_sent_event("", event="done")
+        except Exception as e:
+            logger.error(f"Error streaming forecast: {str(e)}")
+            yield server_sent_event(str(e), event="error")
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def canonical_forecast(daily_forecast):
+    """JSON encoding of the forecast with timestamps rounded to the hour"""
+    rounded = [
+        {**entry, "dt": entry["dt"] - entry["dt"] % 3600} if "dt" in entry else entry
+        for entry in daily_forecast
+    ]
+    return json.dumps(rounded, sort_keys=True)
+
+
+def forecast_text_cache_dir():
+    """The narration cache directory, or None if other users could write to it
+
+    The directory is created private to this user. An existing one is only
+    used if this user owns it and nobody else can write to it, otherwise
+    narrations planted there would be read to Omi users.
+    """
+    try:
+        FORECAST_TEXT_CACHE_DIR.mkdir(mode=0o700, parents=True, exist_ok=True)
+        dir_stat = FORECAST_TEXT_CACHE_DIR.lstat()
+        if (
+            not stat.S_ISDIR(dir_stat.st_mode)
+            or dir_stat.st_uid != os.getuid()
+            or dir_stat.st_mode & 0o022
+        ):
+            return None
+        if dir_stat.st_mode & 0o077:
+            FORECAST_TEXT_CACHE_DIR.chmod(0o700)
+    except OSError:
+        return None
+    return FORECAST_TEXT_CACHE_DIR
+
+
+def read_cached_forecast_text(key):
+    """Return the cached narration for key, or None if missing or expired"""
+    cache_dir = forecast_text_cache_dir()
+    if cache_dir is None:
+        return None
+    path = cache_dir / f"{key}.json"
+    try:
+        if time.time() - path.stat().st_mtime > FORECAST_TEXT_CACHE_TTL:
+            return None
+        return json.loads(path.read_text())["content"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def write_cached_forecast_text(key, content):
+    """Atomically store a narration so concurrent readers never see partial files"""
+    cache_dir = forecast_text_cache_dir()
+    if cache_dir is None:
+        return
+    path = cache_dir / f"{key}.json"
+    tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        tmp_path.write_text(json.dumps({"content": content}))
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning(f"Could not write forecast cache {path}: {str(e)}")
+
+
+def sweep_forecast_text_cache():
+    """Remove expired narrations and leftover temporary files"""
+    cache_dir = forecast_text_cache_dir()
+    if cache_dir is None:
+        logger.warning(
+            f"Forecast cache {FORECAST_TEXT_CACHE_DIR} is disabled, it must be a "
+            "directory owned by this user that nobody else can write to"
+        )
+        return
+    cutoff = time.time() - FORECAST_TEXT_CACHE_TTL
+    for path in cache_dir.iterdir():
+        try:
+            if path.stat().st_mtime < cutoff:
+                path.unlink()
+        except OSError:
+            pass
+
+
+NO_FORECAST_TEXT = "No forecast is available for this location."
+
+
+def stream_forecast_text(daily_forecast):
+    """Yield the forecast text in chunks as OpenAI generates it"""
+    if not daily_forecast:
+        # Nothing to narrate, don't spend an OpenAI call on it
+        yield NO_FORECAST_TEXT
+        return
+
     # Convert the forecast response into a nice text using OpenAI
-    prompt = f"Convert the following forecast data into a friendly text which will be read: {daily_forecast}"
-    response = client.chat.completions.create(
-        model="gpt-4",
-        messages=[
-            {
-                "role": "system",
-                "content": "You are Omi, a helpful AI assistant. Provide clear, concise, and friendly responses.",
-            },
+    prompt = f"Convert the following forecast data into a friendly text which will be read: {canonical_forecast(daily_forecast)}"
+    key = hashlib.sha256(f"{MODEL}\0{SYSTEM_PROMPT}\0{prompt}".encode()).hexdigest()
+
+    forecast_text = read_cached_forecast_text(key)
+    if forecast_text is not None:
+        logger.info(f"X-Cache: HIT {key}")
+        yield forecast_text
+        return
+    logger.info(f"X-Cache: MISS {key}")
+
+    response = create_chat_completion(
+        [
+            SYSTEM_MESSAGE,
             {"role": "user", "content": prompt},
         ],
-        temperature=0.7,
         max_tokens=250,
-        timeout=30,
+        stream=True,
     )
 
-    forecast_text = response.choices[0].message.content.strip()
-    return forecast_text
+    chunks = []
+    # Closes the connection to OpenAI also when the client goes away mid-stream
+    with response:
+        for chunk in response:
+            content = chunk.choices[0].delta.content if chunk.choices else None
+            if content:
+                chunks.append(content)
+                yield content
 
+    forecast_text = "".join(chunks).strip()
+    # An empty completion would otherwise be served for the whole TTL
+    if forecast_text:
+        write_cached_forecast_text(key, forecast_text)
 
-# Function to get weather forecast based on city and country
-def get_weather_forecast(city, country):
-    try:
-        geocode_response = requests.get(
-            f'https://maps.googleapis.com/maps/api/geocode/json?address={city},{country}&key={os.getenv("GOOGLE_GEOCODING_API_KEY")}'
-        )
 
-        geocode_data = geocode_response.json()
-        results = geocode_data.get("results", [])
+def generate_forecast_text(daily_forecast):
+    return "".join(stream_forecast_text(daily_forecast)).strip()
 
-        if not results:
-            return "Location not found"
 
-        geometry = results[0]["geometry"]
-        lat = geometry["location"]["lat"]
-        lng = geometry["location"]["lng"]
+def request_geocode(city, country):
+    """Resolve city and country to (lat, lng) using Google Geocoding, uncached
 
-        weather_response = requests.get(
-            f'https://api.openweathermap.org/data/2.5/forecast?lat={lat}&lon={lng}&units=metric&exclude=minutely,hourly&appid={os.getenv("OPENWEATHER_API_KEY")}'
-        )
+    Used directly for speculative lookups, whose result is only cached by
+    remember_geocode once it turns out to be the location asked for.
+    """
+    geocode_response = session.get(
+        GEOCODE_URL,
+        params={"address": f"{city},{country}", "key": GOOGLE_GEOCODING_API_KEY},
+        timeout=HTTP_TIMEOUT,
+    )
+
+    geocode_data = orjson.loads(geocode_response.content)
+    results = geocode_data.get("results", [])
+
+    if not results:
+        raise LookupError("Location not found")
+
+    geometry = results[0]["geometry"]
+    return geometry["location"]["lat"], geometry["location"]["lng"]
+
+
+def geocode_cache_key(city, country):
+    """Cache key of a geocoding query, Google treats addresses case-insensitively"""
+    return hashkey(city.casefold(), country.casefold())
+
+
+@cached(
+    TTLCache(maxsize=10_000, ttl=GEOCODE_CACHE_TTL),
+    key=geocode_cache_key,
+    lock=threading.Lock(),
+)
+def geocode_location(city, country):
+    """Resolve city and country to (lat, lng) using Google Geocoding"""
+    return request_geocode(city, country)
 
-        if weather_response.status_code != 200:
-            return weather_response.reason
 
-        forecast_data = weather_response.json().get("list", [])
+def remember_geocode(city, country, coordinates):
+    """Store coordinates request_geocode returned for city and country"""
+    with geocode_location.cache_lock:
+        geocode_location.cache[geocode_location.cache_key(city, country)] = coordinates
 
-        current_weather = forecast_data[0] if forecast_data else {}
-        daily_forecast = [forecast_data[i] for i in range(0, len(forecast_data), 8)]
+
+@cached(TTLCache(maxsize=10_000, ttl=FORECAST_CACHE_TTL), lock=threading.Lock())
+def fetch_forecast(lat, lng):
+    """Fetch the 3-hourly forecast list for (lat, lng) from OpenWeather"""
+    weather_response = session.get(
+        FORECAST_URL,
+        params={
+            "lat": lat,
+            "lon": lng,
+            "units": "metric",
+            "exclude": "minutely,hourly",
+            "appid": OPENWEATHER_API_KEY,
+        },
+        timeout=HTTP_TIMEOUT,
+    )
+
+    if weather_response.status_code != 200:
+        raise requests.HTTPError(weather_response.reason)
+
+    return orjson.loads(weather_response.content).get("list", [])
+
+
+def get_daily_forecast(city, country, coordinates=None):
+    """One forecast entry per day (every 8th 3-hour step) for the location"""
+    lat, lng = coordinates or geocode_location(city, country)
+    forecast_data = fetch_forecast(lat, lng)
+
+    return forecast_data[::8]
+
+
+# Function to get weather forecast based on city and country
+def get_weather_forecast(city, country, coordinates=None):
+    try:
+        daily_forecast = get_daily_forecast(city, country, coordinates)
 
         forecast_text = generate_forecast_text(daily_forecast)
 
@@ -414,5 +1130,10 @@ def get_weather_forecast(city, country):
         return str(e)
 
 
+sweep_forecast_text_cache()
+
+
+# Local development only, in production the app is served by gunicorn with
+# gevent workers (see Procfile) since every webhook blocks on network I/O
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000, debug=True)
+    app.run(host="0.0.0.0", port=5000, threaded=True)
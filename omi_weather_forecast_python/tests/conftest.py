@@ -0,0 +1,5 @@
+import os
+
+# weather_omi reads its API keys at import time
+for key in ("OPENAI_API_KEY", "GOOGLE_GEOCODING_API_KEY", "OPENWEATHER_API_KEY"):
+    os.environ.setdefault(key, "test")
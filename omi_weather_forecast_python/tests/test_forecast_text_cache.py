@@ -0,0 +1,105 @@
+import os
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from omi_weather_forecast import weather_omi
+from omi_weather_forecast.weather_omi import (
+    FORECAST_TEXT_CACHE_TTL,
+    read_cached_forecast_text,
+    stream_forecast_text,
+    sweep_forecast_text_cache,
+    write_cached_forecast_text,
+)
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    cache_dir = tmp_path / "cache"
+    monkeypatch.setattr(weather_omi, "FORECAST_TEXT_CACHE_DIR", cache_dir)
+    return cache_dir
+
+
+def age(path, seconds):
+    mtime = time.time() - seconds
+    os.utime(path, (mtime, mtime))
+
+
+def test_write_and_read(cache_dir):
+    write_cached_forecast_text("key", "Sunny all week.")
+    assert read_cached_forecast_text("key") == "Sunny all week."
+    # Written atomically, no temporary file is left behind
+    assert [path.name for path in cache_dir.iterdir()] == ["key.json"]
+    assert cache_dir.stat().st_mode & 0o777 == 0o700
+
+
+def test_read_missing(cache_dir):
+    assert read_cached_forecast_text("missing") is None
+
+
+def test_read_expired(cache_dir):
+    write_cached_forecast_text("key", "Sunny all week.")
+    age(cache_dir / "key.json", FORECAST_TEXT_CACHE_TTL + 1)
+    assert read_cached_forecast_text("key") is None
+
+
+def test_sweep(cache_dir):
+    write_cached_forecast_text("fresh", "Sunny all week.")
+    write_cached_forecast_text("expired", "Rain all week.")
+    age(cache_dir / "expired.json", FORECAST_TEXT_CACHE_TTL + 1)
+    leftover = cache_dir / "crashed.123.456.tmp"
+    leftover.write_text("{")
+    age(leftover, FORECAST_TEXT_CACHE_TTL + 1)
+
+    sweep_forecast_text_cache()
+
+    assert [path.name for path in cache_dir.iterdir()] == ["fresh.json"]
+
+
+def test_other_users_can_write(cache_dir):
+    cache_dir.mkdir()
+    (cache_dir / "key.json").write_text('{"content": "Planted."}')
+    cache_dir.chmod(0o777)
+
+    assert read_cached_forecast_text("key") is None
+    write_cached_forecast_text("other", "Sunny all week.")
+    assert not (cache_dir / "other.json").exists()
+
+
+def test_private_permissions_restored(cache_dir):
+    cache_dir.mkdir(mode=0o755)
+    write_cached_forecast_text("key", "Sunny all week.")
+    assert read_cached_forecast_text("key") == "Sunny all week."
+    assert cache_dir.stat().st_mode & 0o777 == 0o700
+
+
+class FakeStream:
+    def __init__(self, *contents):
+        self.contents = contents
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def __iter__(self):
+        for content in self.contents:
+            yield SimpleNamespace(
+                choices=[SimpleNamespace(delta=SimpleNamespace(content=content))]
+            )
+
+
+@pytest.mark.parametrize(
+    "contents, cached", [(("Sunny", " all week."), True), (("", "  "), False)]
+)
+def test_only_non_empty_text_is_cached(cache_dir, monkeypatch, contents, cached):
+    monkeypatch.setattr(
+        weather_omi,
+        "create_chat_completion",
+        lambda *args, **kwargs: FakeStream(*contents),
+    )
+    text = "".join(stream_forecast_text([{"dt": 1700000000}]))
+    assert text == "".join(contents)
+    assert bool(list(cache_dir.glob("*.json"))) is cached
@@ -0,0 +1,49 @@
+import pytest
+
+from omi_weather_forecast.weather_omi import find_known_city
+
+
+@pytest.mark.parametrize(
+    "question, location",
+    [
+        ("What is the weather in Berlin?", "Berlin, Germany"),
+        ("What's the weather for New York?", "New York City, New York"),
+        ("How is the weather in Paris, Texas?", "Paris, Texas"),
+        ("How is the weather in London Canada?", "London, Canada"),
+        # Only the region right after the city counts
+        (
+            "I am from France, what's the weather in Paris, Texas?",
+            "Paris, Texas",
+        ),
+        # Canonical names win over alternate names of bigger cities
+        ("What's the weather in Islamabad?", "Islamabad, Pakistan"),
+    ],
+)
+def test_known_city(question, location):
+    assert find_known_city(question) == location
+
+
+@pytest.mark.parametrize(
+    "question",
+    [
+        # Alternate names of other cities, or too ambiguous
+        "What's the weather in Vienne?",
+        "What's the weather in Bethlehem?",
+        "What's the weather in Medina?",
+        "What's the weather in San Miguel?",
+        "What's the weather in Victoria?",
+        # Common words that are also city names
+        "Will it be dry in time for the game?",
+        "Is it warm in spring?",
+        "Is it nice for reading outside?",
+        "Will it rain at university?",
+        # Counties and provinces sharing a name with a city
+        "Will it rain in Kent?",
+        "What's the weather in Ontario?",
+        # Region name containing a comma
+        "What's the weather in Kralendijk?",
+        "What's the weather like?",
+    ],
+)
+def test_left_to_gpt(question):
+    assert find_known_city(question) is None
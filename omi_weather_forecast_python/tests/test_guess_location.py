@@ -0,0 +1,39 @@
+import pytest
+
+from omi_weather_forecast.weather_omi import guess_location, guess_matches
+
+
+@pytest.mark.parametrize(
+    "question, location",
+    [
+        ("What's the weather in Smalltown, Germany?", ("Smalltown", "Germany")),
+        ("How is the weather in Cambridge, UK?", ("Cambridge", "United Kingdom")),
+        ("Will it rain at noon in Paris, Texas?", ("Paris", "Texas")),
+    ],
+)
+def test_guess_location(question, location):
+    assert guess_location(question) == location
+
+
+@pytest.mark.parametrize(
+    "question",
+    [
+        # Without a country the geocoded place may not be the one OpenAI picks
+        "What's the weather in Victoria?",
+        "What's the weather at noon?",
+        "What's the weather at the moment?",
+        "Is it dry enough for my run?",
+        "Is it sunny in the park?",
+        "Is it sunny in the park, today?",
+    ],
+)
+def test_no_guess(question):
+    assert guess_location(question) is None
+
+
+def test_guess_must_match_exactly():
+    guessed_location = guess_location("What's the weather in Victoria, Canada?")
+    assert guess_matches(guessed_location, "Victoria", "Canada")
+    assert guess_matches(guessed_location, "victoria", "canada")
+    assert not guess_matches(guessed_location, "Victoria", "Australia")
+    assert not guess_matches(guessed_location, "Victoria City", "Canada")
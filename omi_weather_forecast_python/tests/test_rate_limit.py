@@ -0,0 +1,115 @@
+from types import SimpleNamespace
+
+import httpx
+import pytest
+
+from omi_weather_forecast import weather_omi
+from omi_weather_forecast.weather_omi import (
+    APIConnectionError,
+    OPENAI_RATE_LIMIT_MAX_WAIT,
+    RateLimitError,
+    TokenBucket,
+    is_retryable,
+    wait_for_retry,
+)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Fake monotonic clock, sleeping advances it instead of waiting"""
+    clock = SimpleNamespace(now=1000.0, sleeps=[])
+
+    def sleep(seconds):
+        clock.sleeps.append(seconds)
+        clock.now += seconds
+
+    monkeypatch.setattr(weather_omi.time, "monotonic", lambda: clock.now)
+    monkeypatch.setattr(weather_omi.time, "sleep", sleep)
+    return clock
+
+
+def rate_limit_error(code=None, retry_after=None):
+    headers = {"retry-after": retry_after} if retry_after is not None else {}
+    response = httpx.Response(
+        429, headers=headers, request=httpx.Request("POST", "https://api.test")
+    )
+    body = {"code": code} if code else None
+    return RateLimitError("Rate limit reached", response=response, body=body)
+
+
+def retry_state(error, attempt_number=1):
+    return SimpleNamespace(
+        outcome=SimpleNamespace(exception=lambda: error),
+        attempt_number=attempt_number,
+    )
+
+
+def test_acquire_within_budget_does_not_wait(clock):
+    bucket = TokenBucket(requests_per_minute=2, tokens_per_minute=100)
+    bucket.acquire(40)
+    bucket.acquire(40)
+    assert clock.sleeps == []
+    assert bucket.available_requests == pytest.approx(0)
+    assert bucket.available_tokens == pytest.approx(20)
+
+
+def test_acquire_waits_for_requests(clock):
+    bucket = TokenBucket(requests_per_minute=2, tokens_per_minute=100)
+    bucket.acquire(1)
+    bucket.acquire(1)
+    bucket.acquire(1)
+    # One request refills every 30 seconds
+    assert clock.sleeps == [pytest.approx(30)]
+
+
+def test_acquire_waits_for_tokens(clock):
+    bucket = TokenBucket(requests_per_minute=100, tokens_per_minute=60)
+    bucket.acquire(60)
+    bucket.acquire(15)
+    # One token refills every second
+    assert clock.sleeps == [pytest.approx(15)]
+
+
+def test_acquire_clamps_to_bucket_size(clock):
+    bucket = TokenBucket(requests_per_minute=100, tokens_per_minute=60)
+    bucket.acquire(1000)
+    assert clock.sleeps == []
+
+
+def test_refill_is_capped(clock):
+    bucket = TokenBucket(requests_per_minute=2, tokens_per_minute=100)
+    bucket.acquire(100)
+    clock.now += 3600
+    bucket.refill()
+    assert bucket.available_requests == 2
+    assert bucket.available_tokens == 100
+
+
+@pytest.mark.parametrize(
+    "error, retryable",
+    [
+        (rate_limit_error(), True),
+        (rate_limit_error(code="rate_limit_exceeded"), True),
+        (rate_limit_error(code="insufficient_quota"), False),
+        (APIConnectionError(request=httpx.Request("POST", "https://api.test")), True),
+        (ValueError("not an API error"), False),
+    ],
+)
+def test_is_retryable(error, retryable):
+    assert is_retryable(error) is retryable
+
+
+def test_wait_for_retry_honours_retry_after():
+    assert wait_for_retry(retry_state(rate_limit_error(retry_after="7"))) == 7
+
+
+def test_wait_for_retry_caps_retry_after():
+    error = rate_limit_error(retry_after="3600")
+    assert wait_for_retry(retry_state(error)) == OPENAI_RATE_LIMIT_MAX_WAIT
+
+
+@pytest.mark.parametrize("retry_after", [None, "soon"])
+def test_wait_for_retry_backs_off_without_retry_after(retry_after):
+    error = rate_limit_error(retry_after=retry_after)
+    assert wait_for_retry(retry_state(error)) == 4
+    assert wait_for_retry(retry_state(error, attempt_number=5)) == 10
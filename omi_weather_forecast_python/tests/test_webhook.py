@@ -0,0 +1,38 @@
+import pytest
+
+from omi_weather_forecast.weather_omi import app
+
+
+@pytest.fixture
+def client():
+    return app.test_client()
+
+
+@pytest.mark.parametrize(
+    "payload",
+    [
+        [],
+        "hey omi",
+        {"segments": [{"text": "hey omi"}]},
+        {"session_id": 1, "segments": [{"text": "hey omi"}]},
+        {"session_id": "s", "segments": None},
+        {"session_id": "s", "segments": {"text": "hey omi"}},
+        {"session_id": "s", "segments": ["hey omi"]},
+        {"session_id": "s", "segments": [{"text": None}]},
+        {"session_id": "s", "segments": [{"text": 42}]},
+        {"session_id": "s", "segments": [{"speaker": "SPEAKER_0"}]},
+    ],
+)
+def test_invalid_payload(client, payload):
+    response = client.post("/webhook", json=payload)
+    assert response.status_code == 400
+    assert response.json["status"] == "error"
+
+
+@pytest.mark.parametrize("segments", [[], [{"text": ""}], [{"text": "hello"}]])
+def test_no_question(client, segments):
+    response = client.post(
+        "/webhook", json={"session_id": "test-no-question", "segments": segments}
+    )
+    assert response.status_code == 200
+    assert response.json == {"status": "success"}